@@ -1,67 +1,310 @@
 import os
 import re
+import asyncio
 import json
+import time
+import sqlite3
+import hashlib
 import logging
-import uvicorn
-from fastapi import FastAPI, HTTPException, Body
+import functools
+import threading
+import contextlib
+import queue
+import importlib
+from collections import OrderedDict
+from fastapi import FastAPI, HTTPException, Body, Header, Response
+from fastapi.responses import StreamingResponse
 from dotenv import load_dotenv
 
 load_dotenv()
-from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any, Literal
+from pydantic import BaseModel, Field, ValidationError
+from typing import List, Optional, Dict, Any, Literal, Tuple, NamedTuple
 
-# logger = logging.getLogger("devsentinel")
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "WARNING").upper())
+logger = logging.getLogger("devsentinel")
 
 
-# 1. Groq (LLM)
-from groq import Groq
-
-# 2. ChromaDB (Vector Memory)
-import chromadb
-from chromadb.config import Settings
-
-# 3. Tree-sitter (AST Parsing)
-# NOTE: New 2025 usage requires specific language binding imports
+# Heavy dependencies are imported on first use to keep startup (and every
+# `uvicorn --reload`) fast; chromadb alone takes most of a second to import.
+# 1. Groq (LLM): get_groq_client
+# 2. ChromaDB (Vector Memory): get_chroma_client, get_embedding_function
+# 3. Tree-sitter (AST Parsing): core binding here, grammars via get_language
 from tree_sitter import Language, Parser
-import tree_sitter_python as tspython
-import tree_sitter_javascript as tsjavascript
-import tree_sitter_typescript as tstypescript
 
 app = FastAPI(title="DevSentinel Backend")
 
 # --- CONFIGURATION ---
 GROQ_API_KEY = os.environ.get("GROQ_API_KEY")
 if not GROQ_API_KEY:
-    print("⚠️ WARNING: GROQ_API_KEY not found in environment variables.")
+    logger.warning("GROQ_API_KEY not found in environment variables.")
+
+# Initialize Clients (lazy — constructed on first use)
+_groq_client = None
 
-# Initialize Clients
-groq_client = Groq(api_key=GROQ_API_KEY)
+def get_groq_client():
+    global _groq_client
+    if _groq_client is None:
+        from groq import AsyncGroq
+        _groq_client = AsyncGroq(api_key=GROQ_API_KEY)
+    return _groq_client
 
 # Initialize Vector DB (lazy — initialized on first use to avoid blocking)
 _chroma_client = None
 _style_collection = None
 
+def get_chroma_client():
+    global _chroma_client
+    if _chroma_client is None:
+        logger.debug("Initializing ChromaDB client...")
+        import chromadb
+        _chroma_client = chromadb.PersistentClient(path="./chroma_db")
+    return _chroma_client
+
+# HNSW index tuning for the style guide: a denser graph (M=32) built with a wider
+# beam gives better recall, while a smaller search beam keeps queries fast on the
+# small corpora a style guide produces. Chroma has no quantization option.
+STYLE_INDEX_METADATA = {
+    "hnsw:space": "cosine",
+    "hnsw:M": 32,
+    "hnsw:construction_ef": 200,
+    "hnsw:search_ef": 64,
+    "hnsw:num_threads": 4,
+}
+
 def get_style_collection():
-    global _chroma_client, _style_collection
-    print("[DEBUG] Getting style collection...")
+    global _style_collection
     if _style_collection is None:
-        print("[DEBUG] Initializing ChromaDB client...")
-        _chroma_client = chromadb.PersistentClient(path="./chroma_db")
-        _style_collection = _chroma_client.get_or_create_collection(name="style_guide")
-        print("[DEBUG] ChromaDB client initialized and collection created/retrieved.")
-    else:
-        print("[DEBUG] Using cached style collection.")
+        _style_collection = get_chroma_client().get_or_create_collection(
+            name="style_guide",
+            embedding_function=get_embedding_function(),
+            metadata=STYLE_INDEX_METADATA,
+        )
+        logger.debug("Style collection created/retrieved.")
     return _style_collection
 
-# Initialize AST Language Map (keyed by file extension)
-LANGUAGE_MAP = {
-    ".py": Language(tspython.language()),
-    ".js": Language(tsjavascript.language()),
-    ".jsx": Language(tsjavascript.language()),
-    ".ts": Language(tstypescript.language_typescript()),
-    ".tsx": Language(tstypescript.language_tsx()),
+def _style_index_is_current(collection) -> bool:
+    """Index parameters are fixed at creation, so older collections keep Chroma's defaults."""
+    hnsw = (getattr(collection, "configuration_json", None) or {}).get("hnsw")
+    if hnsw:
+        return (hnsw.get("space") == STYLE_INDEX_METADATA["hnsw:space"]
+                and hnsw.get("max_neighbors") == STYLE_INDEX_METADATA["hnsw:M"])
+    # Older Chroma releases keep the index settings in collection metadata
+    metadata = collection.metadata or {}
+    return all(metadata.get(key) == STYLE_INDEX_METADATA[key] for key in ("hnsw:space", "hnsw:M"))
+
+STYLE_QUERY_CHARS = 500  # Leading slice of the file used as the RAG query
+
+@functools.lru_cache(maxsize=1024)
+def _embed_style_query(text: str) -> Tuple[float, ...]:
+    # Keyed on the text itself; it is at most STYLE_QUERY_CHARS long
+    return tuple(embed_texts([text])[0])
+
+def query_style_rules(code: str, n_results: int = 3) -> Dict[str, Any]:
+    """Fetch the style-guide chunks most relevant to the given code."""
+    # Files re-submitted with the same header reuse the query embedding
+    text = code[:STYLE_QUERY_CHARS]
+    embedding = _embed_style_query(text)
+    return get_style_collection().query(
+        query_embeddings=[list(embedding)],
+        n_results=n_results
+    )
+
+# --- SEMANTIC RESPONSE CACHE ---
+# LLM responses are cached per endpoint in their own Chroma collection, keyed by
+# content hash and an embedding of the file. Identical files, and near-identical
+# resubmissions of the same file short enough to embed whole, skip Groq entirely.
+SEMANTIC_CACHE_THRESHOLD = 0.87  # Minimum cosine similarity for a cache hit
+SEMANTIC_CACHE_MAX_ENTRIES = 500  # Per endpoint; least recently used are evicted
+SEMANTIC_CACHE_EVICT_BATCH = 50
+
+EMBEDDING_BATCH_SIZE = 64
+
+_embedding_function = None
+_encoder_tokenizer = None
+_cache_collections = {}
+
+def get_embedding_function():
+    """Local all-MiniLM-L6-v2 (ONNX) encoder, shared by every collection."""
+    global _embedding_function
+    if _embedding_function is None:
+        from chromadb.utils import embedding_functions
+        _embedding_function = embedding_functions.DefaultEmbeddingFunction()
+    return _embedding_function
+
+def get_cache_collection(endpoint: str):
+    if endpoint not in _cache_collections:
+        _cache_collections[endpoint] = get_chroma_client().get_or_create_collection(
+            name=f"llm_cache_{endpoint}",
+            metadata={"hnsw:space": "cosine"},
+        )
+    return _cache_collections[endpoint]
+
+def clear_semantic_cache(endpoint: str):
+    """Drop every cached response for an endpoint (e.g. after the style guide changes)."""
+    try:
+        get_chroma_client().delete_collection(name=f"llm_cache_{endpoint}")
+    except Exception as e:
+        logger.warning("Could not clear %s cache: %s", endpoint, safe_error_message(e))
+    _cache_collections.pop(endpoint, None)
+
+def embed_texts(texts: List[str]) -> List[List[float]]:
+    """Encode texts with the shared encoder, EMBEDDING_BATCH_SIZE at a time."""
+    encoder = get_embedding_function()
+    embeddings = []
+    for start in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+        batch = encoder(texts[start:start + EMBEDDING_BATCH_SIZE])
+        embeddings.extend([float(x) for x in vector] for vector in batch)
+    return embeddings
+
+class CodeEmbedding(NamedTuple):
+    vector: List[float]
+    whole_file: bool  # False when the encoder only saw a truncated prefix
+
+def get_encoder_tokenizer():
+    """Tokenizer of the shared encoder, truncating at the same window the encoder does."""
+    global _encoder_tokenizer
+    if _encoder_tokenizer is None:
+        from chromadb.utils.embedding_functions.onnx_mini_lm_l6_v2 import ONNXMiniLM_L6_V2
+        _encoder_tokenizer = ONNXMiniLM_L6_V2().tokenizer
+    return _encoder_tokenizer
+
+def fits_encoder_window(code: str) -> bool:
+    """True if the encoder embeds all of code rather than just its first tokens."""
+    try:
+        return not get_encoder_tokenizer().encode(code).overflowing
+    except Exception as e:
+        logger.warning("Tokenizer unavailable, using exact cache matches only: %s", safe_error_message(e))
+        return False
+
+def embed_code(code: str) -> Optional[CodeEmbedding]:
+    """Embed file content for cache lookups. Returns None if the encoder is unavailable."""
+    try:
+        vector = embed_texts([code])[0]
+    except Exception as e:
+        logger.warning("Embedding failed, semantic cache disabled for this request: %s", safe_error_message(e))
+        return None
+    return CodeEmbedding(vector, fits_encoder_window(code))
+
+def _cache_id(ext: str, content_hash: str) -> str:
+    return f"{ext}:{content_hash}"
+
+def _exact_cache_lookup(endpoint: str, ext: str, content_hash: str) -> Optional["ReviewResponse"]:
+    try:
+        collection = get_cache_collection(endpoint)
+        exact = collection.get(ids=[_cache_id(ext, content_hash)], include=["documents"])
+        if not exact["ids"]:
+            return None
+        cached = ReviewResponse.model_validate_json(exact["documents"][0])
+        collection.update(ids=exact["ids"], metadatas=[{"last_access": time.time()}])
+        logger.info("Exact cache hit for %s", endpoint)
+        return cached
+    except Exception as e:
+        logger.warning("Exact cache lookup failed: %s", safe_error_message(e))
+        return None
+
+def _similar_cache_lookup(endpoint: str, ext: str, file_path: str, embedding: CodeEmbedding) -> Optional["ReviewResponse"]:
+    try:
+        collection = get_cache_collection(endpoint)
+        results = collection.query(
+            query_embeddings=[embedding.vector],
+            n_results=1,
+            where={"$and": [{"endpoint": endpoint}, {"ext": ext}, {"file_path": file_path}]},
+        )
+        if not results["ids"] or not results["ids"][0]:
+            return None
+        # Cosine distance = 1 - cosine similarity
+        if results["distances"][0][0] >= 1 - SEMANTIC_CACHE_THRESHOLD:
+            return None
+
+        cached = ReviewResponse.model_validate_json(results["documents"][0][0])
+        collection.update(ids=[results["ids"][0][0]], metadatas=[{"last_access": time.time()}])
+        logger.info("Semantic cache hit for %s (distance %.4f)", endpoint, results["distances"][0][0])
+        return cached
+    except Exception as e:
+        logger.warning("Semantic cache lookup failed: %s", safe_error_message(e))
+        return None
+
+def semantic_cache_lookup(endpoint: str, ext: str, file_path: str, content_hash: str,
+                          code: str) -> Tuple[Optional["ReviewResponse"], Optional[CodeEmbedding]]:
+    """
+    Look up a cached response: exact content first, then the closest stored file.
+    Returns (response, None) on a hit, otherwise (None, embedding) so the caller
+    can store the fresh response without embedding the file twice.
+
+    The file is only embedded when the exact lookup misses, and similarity
+    matching is only used when the encoder saw the whole file; a truncated
+    embedding cannot tell apart files that share their first lines.
+    """
+    cached = _exact_cache_lookup(endpoint, ext, content_hash)
+    if cached is not None:
+        return cached, None
+    embedding = embed_code(code)
+    if embedding is None or not embedding.whole_file:
+        return None, embedding
+    return _similar_cache_lookup(endpoint, ext, file_path, embedding), embedding
+
+def semantic_cache_store(endpoint: str, ext: str, file_path: str, content_hash: str,
+                         embedding: Optional[CodeEmbedding], response: "ReviewResponse"):
+    """Store an LLM response, evicting the least recently used entries when full."""
+    if embedding is None:
+        return
+    try:
+        collection = get_cache_collection(endpoint)
+        collection.upsert(
+            ids=[_cache_id(ext, content_hash)],
+            embeddings=[embedding.vector],
+            documents=[response.model_dump_json()],
+            metadatas=[{"endpoint": endpoint, "ext": ext, "file_path": file_path, "last_access": time.time()}],
+        )
+        if collection.count() > SEMANTIC_CACHE_MAX_ENTRIES:
+            _evict_stale_cache_entries(collection)
+    except Exception as e:
+        logger.warning("Semantic cache store failed: %s", safe_error_message(e))
+
+def _evict_stale_cache_entries(collection):
+    entries = collection.get(include=["metadatas"])
+    by_access = sorted(
+        zip(entries["ids"], entries["metadatas"]),
+        key=lambda entry: (entry[1] or {}).get("last_access", 0),
+    )
+    overflow = len(by_access) - SEMANTIC_CACHE_MAX_ENTRIES + SEMANTIC_CACHE_EVICT_BATCH
+    stale_ids = [entry_id for entry_id, _ in by_access[:overflow]]
+    if stale_ids:
+        collection.delete(ids=stale_ids)
+        logger.debug("Evicted %d stale cache entries.", len(stale_ids))
+
+# AST grammars (keyed by file extension): binding module and the factory that
+# returns its language pointer. Loaded by get_language on first use.
+LANGUAGE_GRAMMARS = {
+    ".py": ("tree_sitter_python", "language"),
+    ".js": ("tree_sitter_javascript", "language"),
+    ".jsx": ("tree_sitter_javascript", "language"),
+    ".ts": ("tree_sitter_typescript", "language_typescript"),
+    ".tsx": ("tree_sitter_typescript", "language_tsx"),
 }
 
+@functools.lru_cache(maxsize=None)
+def get_language(ext: str) -> Language:
+    module_name, factory = LANGUAGE_GRAMMARS[ext]
+    return Language(getattr(importlib.import_module(module_name), factory)())
+
+# Parsers are not thread-safe, so each extension keeps a pool of idle instances.
+# A request borrows one (creating it only if the pool is empty) and returns it
+# afterwards, so concurrent requests never share a parser or wait on a lock.
+_PARSER_POOLS = {ext: queue.SimpleQueue() for ext in LANGUAGE_GRAMMARS}
+
+@contextlib.contextmanager
+def borrow_parser(ext: str):
+    pool = _PARSER_POOLS[ext]
+    try:
+        parser = pool.get_nowait()
+    except queue.Empty:
+        parser = Parser(get_language(ext))
+    try:
+        yield parser
+    finally:
+        pool.put(parser)
+
 LANGUAGE_NAMES = {
     ".py": "Python",
     ".js": "JavaScript",
@@ -70,12 +313,15 @@ LANGUAGE_NAMES = {
     ".tsx": "TypeScript (TSX)",
 }
 
+# JS, JSX, TS and TSX grammars share node names, so they share one frozenset
+_JS_FUNCTION_TYPES = frozenset({"function_declaration", "arrow_function", "class_declaration", "method_definition"})
+
 AST_FUNCTION_TYPES = {
-    ".py": {"function_definition", "class_definition"},
-    ".js": {"function_declaration", "arrow_function", "class_declaration", "method_definition"},
-    ".jsx": {"function_declaration", "arrow_function", "class_declaration", "method_definition"},
-    ".ts": {"function_declaration", "arrow_function", "class_declaration", "method_definition"},
-    ".tsx": {"function_declaration", "arrow_function", "class_declaration", "method_definition"},
+    ".py": frozenset({"function_definition", "class_definition"}),
+    ".js": _JS_FUNCTION_TYPES,
+    ".jsx": _JS_FUNCTION_TYPES,
+    ".ts": _JS_FUNCTION_TYPES,
+    ".tsx": _JS_FUNCTION_TYPES,
 }
 
 DEFAULT_STYLE_RULES = {
@@ -88,6 +334,67 @@ DEFAULT_STYLE_RULES = {
 
 # --- CONSTANTS ---
 MAX_CODE_LENGTH = 100_000  # ~100KB max per field
+MAX_BATCH_FILES = 50  # Files per /review-batch request
+REVIEW_BATCH_CONCURRENCY = 8  # Concurrent Groq calls per /review-batch request
+
+# --- PROMPTS ---
+# Static preambles are sent as the FIRST message so the provider can reuse the
+# cached prefix across requests. Per-request context goes in a later message.
+REVIEW_SYSTEM_PREAMBLE = """You are a Senior Software Architect reviewing code for project alignment and quality.
+
+TASK: Review the ENTIRE file for:
+1. Project alignment: consistent patterns, naming, architecture
+2. Bugs and logic errors
+3. Security vulnerabilities
+4. Code quality: readability, maintainability, error handling
+5. Compliance with the project style rules given in the context
+
+Return a JSON object with a list of "comments". Each comment has:
+- 'line_number': ABSOLUTE 1-based line number in the file
+- 'suggestion': short, actionable suggestion
+- 'fixed_code': the corrected line(s)
+- 'severity': "error" (bugs, crashes, vulnerabilities) | "warning" (smells, risky patterns) | "info" (style, readability) | "hint" (optional nice-to-haves)
+
+CRITICAL:
+- Output MUST be valid JSON.
+- If the code is good, return { "comments": [] }
+- Review the WHOLE file, not just parts of it."""
+
+SECURITY_SYSTEM_PREAMBLE = """You are a Senior Application Security Engineer.
+
+TASK: Audit the code for OWASP Top 10 issues:
+1. SQL Injection
+2. Cross-Site Scripting (XSS)
+3. Path / Directory Traversal
+4. Hardcoded secrets (API keys, passwords, tokens)
+5. Command Injection (os.system, exec, eval, child_process)
+6. Insecure Deserialization (pickle, yaml.load, eval)
+7. Broken Access Control
+8. Sensitive Data Exposure (logged secrets, leaky errors)
+9. Insecure Cryptography (weak hashes, hardcoded IVs, ECB)
+10. Server-Side Request Forgery (SSRF)
+
+Return a JSON object with a list of "comments". Each comment has:
+- 'line_number': ABSOLUTE 1-based line number
+- 'suggestion': the vulnerability and how to fix it
+- 'fixed_code': the secure version of the code
+- 'severity': "error" (confirmed: injection, secrets, command exec) | "warning" (likely or unsafe pattern) | "info" (best practice) | "hint" (minor hardening)
+
+CRITICAL:
+- Output MUST be valid JSON.
+- If there are no security issues, return { "comments": [] }
+- Only report real security concerns, not general code quality."""
+
+ROAST_SYSTEM_PREAMBLE = """You are Linus Torvalds.
+The user has sent you some code. It is probably terrible.
+Your job is to ROAST it. Be brutal, be technical, be funny, but also be educational (deep down).
+
+Rules:
+- Use CAPS for emphasis.
+- Question their life choices.
+- Compare their code to spaghetti, garbage, or worse.
+- BUT, point out actual flaws (logic, variable names, architecture).
+- Keep it under 200 words."""
 
 # --- DATA MODELS ---
 class ReviewRequest(BaseModel):
@@ -103,349 +410,482 @@ class CodeFix(BaseModel):
 class ReviewResponse(BaseModel):
     comments: List[CodeFix]
 
+class BatchReviewRequest(BaseModel):
+    files: List[ReviewRequest] = Field(..., max_length=MAX_BATCH_FILES)
+
+class FileReview(BaseModel):
+    file_path: str
+    comments: List[CodeFix]
+    error: Optional[str] = None
+
+class BatchReviewResponse(BaseModel):
+    reviews: List[FileReview]
+
 # --- HELPER FUNCTIONS ---
+# Redact long alphanumeric tokens (API keys are typically 30+ chars)
+_API_KEY_RE = re.compile(r'(gsk_|sk-)[A-Za-z0-9_-]{20,}')
+# Leading ```json / ``` fence or trailing ``` fence, removed in a single pass
+_JSON_FENCE_RE = re.compile(r'^```(?:json)?\s*|\s*```$')
+
 def safe_error_message(e: Exception) -> str:
     """Strip anything that looks like an API key from error messages."""
-    msg = str(e)
-    # Redact long alphanumeric tokens (API keys are typically 30+ chars)
-    msg = re.sub(r'(gsk_|sk-)[A-Za-z0-9_-]{20,}', '[REDACTED]', msg)
-    return msg
+    return _API_KEY_RE.sub('[REDACTED]', str(e))
 
 def clean_llm_json(raw: str) -> str:
     """Strip markdown fences and fix common LLM JSON issues."""
-    text = raw.strip()
-    # Remove ```json ... ``` wrappers
-    text = re.sub(r'^```(?:json)?\s*', '', text)
-    text = re.sub(r'\s*```$', '', text)
-    return text.strip()
-
-def get_language_name(file_path: str) -> str:
-    """Return a human-readable language name from the file extension."""
-    ext = os.path.splitext(file_path)[1].lower()
-    return LANGUAGE_NAMES.get(ext, "General")
-
-def get_ast_context(code: str, file_path: str) -> str:
-    print(f"[DEBUG] Parsing AST for file: {file_path}")
+    return _JSON_FENCE_RE.sub('', raw.strip()).strip()
+
+def parse_review_response(raw_content: str, label: str) -> Optional[ReviewResponse]:
+    """Parse an LLM review payload, stripping markdown fences if present. Returns None if unparseable."""
+    # JSON mode almost always returns bare JSON, so only run the fence regex when needed
+    stripped = raw_content.strip()
+    if stripped.startswith("```") or stripped.endswith("```"):
+        stripped = clean_llm_json(stripped)
+    try:
+        return ReviewResponse.model_validate_json(stripped)
+    except ValidationError:
+        # Invalid JSON, or valid JSON missing the "comments" key
+        logger.warning("%s LLM returned unparseable response: %.200s", label, stripped)
+        return None
+
+def sse_event(event: str, data: Any) -> str:
+    """Format one Server-Sent Event; data is JSON-encoded so newlines stay escaped."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def stream_completion_tokens(**kwargs):
+    """Yield content deltas from a streamed Groq chat completion."""
+    stream = await get_groq_client().chat.completions.create(stream=True, **kwargs)
+    async for chunk in stream:
+        delta = chunk.choices[0].delta.content if chunk.choices else None
+        if delta:
+            yield delta
+
+def log_token_usage(endpoint: str, completion) -> None:
+    """Log prompt/cached/completion token counts reported by Groq."""
+    usage = getattr(completion, "usage", None)
+    if usage is None:
+        return
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached_tokens = getattr(details, "cached_tokens", None) or 0
+    logger.debug("%s token usage: prompt=%s (cached=%s) completion=%s",
+                 endpoint, usage.prompt_tokens, cached_tokens, usage.completion_tokens)
+
+def content_sha256(code_bytes: bytes) -> str:
+    """Hex SHA-256 of file content; computed once per request and shared by the caches."""
+    return hashlib.sha256(code_bytes).hexdigest()
+
+def compute_etag(file_path: str, content_hash: str, *versions: Any) -> str:
+    """Strong ETag for a file submission; versions capture anything else the response depends on."""
+    key = "\0".join([file_path, content_hash, *map(str, versions)])
+    return f'"{hashlib.sha256(key.encode("utf-8")).hexdigest()}"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Only an explicit match counts; "*" would skip the review of files never seen."""
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+class PreparedFile(NamedTuple):
+    """Per-request facts about a submitted file, derived once up front."""
+    ext: str
+    code_bytes: bytes
+    content_hash: str
+    language_name: str
+    default_style_rules: str
+
+    @property
+    def ast_supported(self) -> bool:
+        return self.ext in LANGUAGE_GRAMMARS
+
+    @property
+    def has_content(self) -> bool:
+        return bool(self.code_bytes.strip())
+
+def _prepare_request(request) -> PreparedFile:
+    """Shared prologue for every endpoint that receives file_path + full_file_content."""
+    ext = os.path.splitext(request.file_path)[1].lower()
+    # Encode once: the parser, its byte offsets and the content hash all use this buffer
+    code_bytes = request.full_file_content.encode("utf-8")
+    return PreparedFile(
+        ext=ext,
+        code_bytes=code_bytes,
+        content_hash=content_sha256(code_bytes),
+        language_name=LANGUAGE_NAMES.get(ext, "General"),
+        default_style_rules=DEFAULT_STYLE_RULES.get(ext, "General best practices."),
+    )
+
+def _plain_text_context(ext: str) -> str:
+    return f"AST parsing not available for '{ext}' files. Reviewing as plain text."
+
+def _ast_context_for_ext(code_bytes: bytes, ext: str, content_hash: str) -> str:
     """
     Parses code to find the high-level structure (Class/Function names).
     This helps the LLM know WHERE the diff is happening.
     Supports Python, JavaScript, and TypeScript.
     """
-    ext = os.path.splitext(file_path)[1].lower()
-    language = LANGUAGE_MAP.get(ext)
-    print(f"[INFO] AST parsing for '{ext}' files.")
-    if not language:
-        return f"AST parsing not available for '{ext}' files. Reviewing as plain text."
-
     try:
-        local_parser = Parser(language)
-        tree = local_parser.parse(bytes(code, "utf8"))
-        function_types = AST_FUNCTION_TYPES.get(ext, set())
-
-        functions = []
-        cursor = tree.walk()
-
-        visited_children = False
-        loop_count = 0
-        while True:
-            loop_count += 1
-            if loop_count > 100000:
-                print(f"[WARNING] AST traversal limit reached for {file_path}. Stopping early.")
-                break
-
-            if not visited_children:
-                node = cursor.node
-                if node.type in function_types:
-                    name_node = node.child_by_field_name("name")
-                    if name_node:
-                        functions.append(code[name_node.start_byte:name_node.end_byte])
-                    elif node.type == "arrow_function":
-                        # Arrow functions: check parent variable_declarator for name
-                        parent = node.parent
-                        if parent and parent.type == "variable_declarator":
-                            pname = parent.child_by_field_name("name")
-                            if pname:
-                                functions.append(code[pname.start_byte:pname.end_byte])
-                            else:
-                                functions.append("<anonymous arrow>")
-                        else:
-                            functions.append("<anonymous arrow>")
-
-            if not visited_children and cursor.goto_first_child():
-                visited_children = False
-            elif cursor.goto_next_sibling():
-                visited_children = False
-            elif cursor.goto_parent():
-                visited_children = True
-            else:
-                break
-
+        functions, _ = analyze_file(code_bytes, ext, content_hash)
         result = f"Found Functions: {', '.join(functions)}" if functions else "Root Level Script"
-        print(f"[DEBUG] AST Parsing result: {result}")
+        logger.debug("AST Parsing result: %s", result)
         return result
     except Exception as e:
-        print(f"[ERROR] AST Parse Error: {str(e)}")
+        logger.error("AST Parse Error: %s", e)
         return f"AST Parse Error: {str(e)}"
 
+async def load_ast_context(prepared: PreparedFile) -> str:
+    # Unsupported file types (.md, .txt, .json, ...) skip the analysis and the thread hop
+    if not prepared.ast_supported:
+        return _plain_text_context(prepared.ext)
+    if not prepared.has_content:
+        return "Empty file"
+    return await asyncio.to_thread(
+        _ast_context_for_ext, prepared.code_bytes, prepared.ext, prepared.content_hash
+    )
+
 # --- API ENDPOINTS ---
 
 @app.get("/")
 def health_check():
     return {"status": "DevSentinel Brain is Active", "model": "llama-3.3-70b-versatile"}
 
+# Part of every /review ETag. Starts at process start, since the guide may have
+# changed while the server was down, and moves forward on each ingest.
+_style_guide_revision = time.time()
+
+def _replace_style_guide(chunks: List[str]):
+    global _style_collection, _style_guide_revision
+    # Content-hash ids: a paragraph that survives an edit keeps its id and index entry
+    by_id = {hashlib.sha1(chunk.encode("utf-8")).hexdigest()[:16]: chunk for chunk in chunks}
+
+    collection = get_style_collection()
+    rebuilt = not _style_index_is_current(collection)
+    if rebuilt:
+        # Every chunk is re-added below anyway, so rebuild with the tuned index
+        logger.info("Rebuilding style_guide collection with tuned HNSW parameters.")
+        get_chroma_client().delete_collection(name="style_guide")
+        _style_collection = None
+        collection = get_style_collection()
+        present = set()
+    else:
+        present = set(collection.get(ids=list(by_id), include=[])["ids"]) if by_id else set()
+        if len(present) == len(by_id) == collection.count():
+            logger.info("Style guide unchanged; nothing to re-index.")
+            return
+
+    # Tag the new guide's chunks with this revision; anything left untagged is stale
+    revision = time.time()
+    metadata = {"source": "style_guide", "revision": revision}
+    if present:
+        collection.update(ids=list(present), metadatas=[metadata] * len(present))
+    missing = [chunk_id for chunk_id in by_id if chunk_id not in present]
+    if missing:
+        documents = [by_id[chunk_id] for chunk_id in missing]
+        collection.add(
+            embeddings=embed_texts(documents),
+            documents=documents,
+            metadatas=[metadata] * len(missing),
+            ids=missing,
+        )
+    if not rebuilt:
+        # Clear old rules in one bulk delete instead of fetching every id
+        collection.delete(where={"$and": [{"source": "style_guide"}, {"revision": {"$ne": revision}}]})
+
+    # Cached reviews were produced against the old rules
+    clear_semantic_cache("review")
+    _style_guide_revision = revision
+
 @app.post("/ingest-style")
-def ingest_style_guide(content: str = Body(..., max_length=MAX_CODE_LENGTH)):
+async def ingest_style_guide(content: str = Body(..., max_length=MAX_CODE_LENGTH)):
     """
     Uploads a STYLE_GUIDE.md to the Vector DB.
     """
-    # Clear old rules to keep it fresh
-    collection = get_style_collection()
-    existing_ids = collection.get()['ids']
-    if existing_ids:
-        collection.delete(ids=existing_ids)
-
     # Chunk by paragraphs (simple strategy)
     chunks = [c.strip() for c in content.split("\n\n") if c.strip()]
-    ids = [str(i) for i in range(len(chunks))]
+    # ChromaDB is synchronous; keep it off the event loop
+    await asyncio.to_thread(_replace_style_guide, chunks)
 
     if chunks:
-        collection.add(documents=chunks, ids=ids)
         return {"status": "success", "chunks_indexed": len(chunks)}
     return {"status": "empty_content"}
 
-@app.post("/review", response_model=ReviewResponse)
-def review_code(request: ReviewRequest):
+async def _build_review_messages(request: ReviewRequest, prepared: PreparedFile) -> List[Dict[str, str]]:
     # 1. AST Analysis
-    print(f"[INFO] Received review request for {request.file_path}")
-
-    ast_context = get_ast_context(request.full_file_content, request.file_path)
-    print(f"[INFO] AST Context: {ast_context}")
+    ast_context = await load_ast_context(prepared)
+    logger.info("AST Context: %s", ast_context)
     # 2. RAG Retrieval (Fetch relevant style rules)
-    print("[INFO] Querying RAG...")
-    ext = os.path.splitext(request.file_path)[1].lower()
-    default_rules = DEFAULT_STYLE_RULES.get(ext, "General best practices.")
-    rag_results = get_style_collection().query(
-        query_texts=[request.full_file_content[:500]],
-        n_results=3
-    )
+    rag_results = await asyncio.to_thread(query_style_rules, request.full_file_content)
     if rag_results['documents']:
-        print(f"[DEBUG] Found {len(rag_results['documents'][0])} RAG documents.")
+        logger.debug("Found %d RAG documents.", len(rag_results['documents'][0]))
         style_rules = "\n- ".join(rag_results['documents'][0])
     else:
-        print("[DEBUG] No RAG documents found, using default rules.")
-        style_rules = default_rules
-
-    # 3. Construct Prompt
-    language_name = get_language_name(request.file_path)
-    system_prompt = f"""
-    You are a Senior {language_name} Architect reviewing code for project alignment and quality.
-
-    CONTEXT:
-    - File Structure: {ast_context}
-    - Project Style Rules:
-      - {style_rules}
-
-    TASK:
-    Review the ENTIRE file for:
-    1. Project alignment — does the code follow consistent patterns, naming conventions, and architecture?
-    2. Bugs and logic errors
-    3. Security vulnerabilities
-    4. Code quality — readability, maintainability, proper error handling
-    5. Style rule compliance (see above)
-
-    Return a JSON object with a list of "comments".
-    For each issue, provide:
-    - 'line_number': The ABSOLUTE line number in the file (1-based).
-    - 'suggestion': A short, actionable suggestion.
-    - 'fixed_code': The corrected line(s) of code.
-    - 'severity': One of "error", "warning", "info", or "hint".
-      - "error": bugs, crashes, security vulnerabilities
-      - "warning": code smells, poor patterns, potential issues
-      - "info": style/readability improvements
-      - "hint": optional suggestions, nice-to-haves
-
-    CRITICAL:
-    - Output MUST be valid JSON.
-    - If the code is good, return an empty list: {{ "comments": [] }}
-    - Review the WHOLE file, not just parts of it.
+        logger.debug("No RAG documents found, using default rules.")
+        style_rules = prepared.default_style_rules
+
+    # 3. Construct Prompt (static preamble first, request context after)
+    context_prompt = (
+        f"CONTEXT:\n"
+        f"- Language: {prepared.language_name}\n"
+        f"- File Structure: {ast_context}\n"
+        f"- Project Style Rules:\n  - {style_rules}"
+    )
+    return [
+        {"role": "system", "content": REVIEW_SYSTEM_PREAMBLE},
+        {"role": "system", "content": context_prompt},
+        {"role": "user", "content": f"FILE: {request.file_path}\n\nCODE:\n{request.full_file_content}"}
+    ]
+
+async def _lookup_cached_response(endpoint: str, request, prepared: PreparedFile) -> Tuple[Optional[ReviewResponse], Optional[CodeEmbedding]]:
+    """Cache step shared by the review and security endpoints; see semantic_cache_lookup."""
+    # Embedding and Chroma are blocking; run them in a worker thread
+    return await asyncio.to_thread(
+        semantic_cache_lookup, endpoint, prepared.ext, request.file_path, prepared.content_hash, request.full_file_content
+    )
+
+async def _store_cached_response(endpoint: str, request, prepared: PreparedFile,
+                                 embedding: Optional[CodeEmbedding], response: ReviewResponse) -> None:
+    await asyncio.to_thread(
+        semantic_cache_store, endpoint, prepared.ext, request.file_path, prepared.content_hash, embedding, response
+    )
+
+async def _run_review(request: ReviewRequest, prepared: PreparedFile) -> Optional[ReviewResponse]:
     """
+    Full review pipeline for one file: semantic cache, AST + RAG context, Groq.
+    Returns None when the LLM reply cannot be parsed.
+    """
+    # 0. Semantic cache (identical or near-identical files reuse the previous review)
+    cached, embedding = await _lookup_cached_response("review", request, prepared)
+    if cached is not None:
+        return cached
+
+    messages = await _build_review_messages(request, prepared)
 
     # 4. Call Groq
-    print("[INFO] Calling Groq API...")
-    try:
-        completion = groq_client.chat.completions.create(
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": f"FILE: {request.file_path}\n\nCODE:\n{request.full_file_content}"}
-            ],
-            model="llama-3.3-70b-versatile",
-            response_format={"type": "json_object"}
-        )
+    completion = await get_groq_client().chat.completions.create(
+        messages=messages,
+        model="llama-3.3-70b-versatile",
+        response_format={"type": "json_object"}
+    )
+    log_token_usage("review", completion)
 
-        raw_content = completion.choices[0].message.content
-        print("[INFO] Groq response received. Parsing...")
+    response = parse_review_response(completion.choices[0].message.content, "Review")
+    if response is not None:
+        await _store_cached_response("review", request, prepared, embedding, response)
+    return response
 
-        # Try direct parse first, then clean and retry
-        try:
-            return ReviewResponse.model_validate_json(raw_content)
-        except Exception:
-            cleaned = clean_llm_json(raw_content)
-            try:
-                data = json.loads(cleaned)
-                return ReviewResponse.model_validate(data)
-            except Exception:
-                # If JSON is valid but missing "comments" key, wrap it
-                print(f"[WARNING] LLM returned unparseable response: {cleaned[:200]}")
-                return ReviewResponse(comments=[])
+@app.post("/review", response_model=ReviewResponse)
+async def review_code(
+    request: ReviewRequest,
+    http_response: Response,
+    if_none_match: Optional[str] = Header(None),
+):
+    logger.info("Received review request for %s", request.file_path)
+    prepared = _prepare_request(request)
+
+    # Byte-identical resubmission: the client already holds this review
+    etag = compute_etag(request.file_path, prepared.content_hash, _style_guide_revision)
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
 
+    try:
+        response = await _run_review(request, prepared)
     except Exception as e:
-        print(f"[ERROR] in review_code: {str(e)}")
+        logger.error("in review_code: %s", safe_error_message(e))
         raise HTTPException(status_code=500, detail=safe_error_message(e))
 
+    if response is None:
+        return ReviewResponse(comments=[])
+    http_response.headers["ETag"] = etag
+    return response
+
+@app.post("/review-batch", response_model=BatchReviewResponse)
+async def review_batch(batch: BatchReviewRequest):
+    """
+    Review several files at once. Files are reviewed concurrently, at most
+    REVIEW_BATCH_CONCURRENCY at a time to stay within Groq rate limits. A failure
+    on one file is reported in its entry instead of failing the whole batch.
+    """
+    logger.info("Received batch review request for %d files", len(batch.files))
+    semaphore = asyncio.Semaphore(REVIEW_BATCH_CONCURRENCY)
+
+    async def review_file(request: ReviewRequest) -> FileReview:
+        prepared = _prepare_request(request)
+        async with semaphore:
+            try:
+                response = await _run_review(request, prepared)
+            except Exception as e:
+                logger.error("in review_batch for %s: %s", request.file_path, safe_error_message(e))
+                return FileReview(file_path=request.file_path, comments=[], error=safe_error_message(e))
+        return FileReview(file_path=request.file_path, comments=response.comments if response else [])
+
+    reviews = await asyncio.gather(*(review_file(request) for request in batch.files))
+    return BatchReviewResponse(reviews=list(reviews))
+
+@app.post("/review/stream")
+async def review_code_stream(request: ReviewRequest):
+    """
+    Same review as /review, streamed as Server-Sent Events: a "token" event per
+    generated chunk, then a "result" event with the parsed ReviewResponse.
+    """
+    logger.info("Received streaming review request for %s", request.file_path)
+    prepared = _prepare_request(request)
+
+    cached, embedding = await _lookup_cached_response("review", request, prepared)
+
+    async def events():
+        if cached is not None:
+            yield sse_event("result", cached.model_dump())
+            return
+
+        chunks = []
+        try:
+            messages = await _build_review_messages(request, prepared)
+            # Groq's JSON mode cannot be streamed; the preamble already demands JSON
+            async for delta in stream_completion_tokens(messages=messages, model="llama-3.3-70b-versatile"):
+                chunks.append(delta)
+                yield sse_event("token", delta)
+        except Exception as e:
+            logger.error("in review_code_stream: %s", safe_error_message(e))
+            yield sse_event("error", {"detail": safe_error_message(e)})
+            return
+
+        response = parse_review_response("".join(chunks), "Review")
+        if response is None:
+            response = ReviewResponse(comments=[])
+        else:
+            await _store_cached_response("review", request, prepared, embedding, response)
+        yield sse_event("result", response.model_dump())
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
 class RoastRequest(BaseModel):
     full_file_content: str = Field(..., max_length=MAX_CODE_LENGTH)
     file_path: str = Field(..., max_length=500)
 
+def _roast_messages(request: RoastRequest) -> List[Dict[str, str]]:
+    return [
+        {"role": "system", "content": ROAST_SYSTEM_PREAMBLE},
+        {"role": "user", "content": f"FILE: {request.file_path}\nCONTENT:\n{request.full_file_content}"}
+    ]
+
 @app.post("/roast")
-def roast_code(request: RoastRequest):
+async def roast_code(request: RoastRequest):
     """
     Roasts the code in the style of Linus Torvalds.
     """
-    print(f"[INFO] Roasting {request.file_path}...")
-    
-    system_prompt = """
-    You are Linus Torvalds. 
-    The user has sent you some code. It is probably terrible.
-    Your job is to ROAST it. Be brutal, be technical, be funny, but also be educational (deep down).
-    
-    Rules:
-    - Use CAPS for emphasis.
-    - Question their life choices.
-    - Compare their code to spaghetti, garbage, or worse.
-    - BUT, point out actual flaws (logic, variable names, architecture).
-    - Keep it under 200 words.
-    """
+    logger.info("Roasting %s...", request.file_path)
     
     try:
-        completion = groq_client.chat.completions.create(
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": f"FILE: {request.file_path}\nCONTENT:\n{request.full_file_content}"}
-            ],
+        completion = await get_groq_client().chat.completions.create(
+            messages=_roast_messages(request),
             model="llama-3.3-70b-versatile"
         )
+        log_token_usage("roast", completion)
         roast = completion.choices[0].message.content
         return {"roast": roast}
     except Exception as e:
-        print(f"[ERROR] in roast_code: {str(e)}")
+        logger.error("in roast_code: %s", safe_error_message(e))
         raise HTTPException(status_code=500, detail=safe_error_message(e))
 
+@app.post("/roast/stream")
+async def roast_code_stream(request: RoastRequest):
+    """
+    Streams the roast as Server-Sent Events: a "token" event per chunk, then "done".
+    """
+    logger.info("Streaming roast for %s...", request.file_path)
+
+    async def events():
+        try:
+            async for delta in stream_completion_tokens(messages=_roast_messages(request), model="llama-3.3-70b-versatile"):
+                yield sse_event("token", delta)
+        except Exception as e:
+            logger.error("in roast_code_stream: %s", safe_error_message(e))
+            yield sse_event("error", {"detail": safe_error_message(e)})
+            return
+        yield sse_event("done", {})
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
 # --- Feature 3: Security Scan ---
 class SecurityScanRequest(BaseModel):
     full_file_content: str = Field(..., max_length=MAX_CODE_LENGTH)
     file_path: str = Field(..., max_length=500)
 
 @app.post("/security-scan", response_model=ReviewResponse)
-def security_scan(request: SecurityScanRequest):
+async def security_scan(request: SecurityScanRequest):
     """Perform a security-focused scan of the code targeting OWASP Top 10."""
-    print(f"[INFO] Security scan requested for {request.file_path}")
-
-    language_name = get_language_name(request.file_path)
-    ast_context = get_ast_context(request.full_file_content, request.file_path)
-
-    system_prompt = f"""
-    You are a Senior Application Security Engineer specializing in {language_name}.
-
-    CONTEXT:
-    - Code Structure: {ast_context}
-
-    TASK:
-    Perform a thorough security audit of the provided code. Focus on OWASP Top 10 vulnerabilities:
-    1. SQL Injection
-    2. Cross-Site Scripting (XSS)
-    3. Path Traversal / Directory Traversal
-    4. Hardcoded Secrets (API keys, passwords, tokens)
-    5. Command Injection (os.system, exec, eval, child_process)
-    6. Insecure Deserialization (pickle, yaml.load, eval)
-    7. Broken Access Control
-    8. Sensitive Data Exposure (logging secrets, error messages leaking info)
-    9. Insecure Cryptography (weak hashing, hardcoded IVs, ECB mode)
-    10. Server-Side Request Forgery (SSRF)
-
-    Return a JSON object with a list of "comments".
-    For each vulnerability found, provide:
-    - 'line_number': The ABSOLUTE line number (1-based).
-    - 'suggestion': Description of the vulnerability and how to fix it.
-    - 'fixed_code': The secure version of the code.
-    - 'severity': One of "error", "warning", "info", or "hint".
-      - "error": confirmed vulnerabilities (injection, hardcoded secrets, command injection)
-      - "warning": likely vulnerabilities or unsafe patterns
-      - "info": security best practice suggestions
-      - "hint": minor hardening suggestions
-
-    CRITICAL:
-    - Output MUST be valid JSON.
-    - If the code has no security issues, return: {{ "comments": [] }}
-    - Only report real security concerns, not general code quality.
-    """
+    logger.info("Security scan requested for %s", request.file_path)
+    prepared = _prepare_request(request)
+
+    cached, embedding = await _lookup_cached_response("security", request, prepared)
+    if cached is not None:
+        return cached
+
+    ast_context = await load_ast_context(prepared)
+
+    context_prompt = (
+        f"CONTEXT:\n"
+        f"- Language: {prepared.language_name}\n"
+        f"- Code Structure: {ast_context}"
+    )
 
     try:
-        completion = groq_client.chat.completions.create(
+        completion = await get_groq_client().chat.completions.create(
             messages=[
-                {"role": "system", "content": system_prompt},
+                {"role": "system", "content": SECURITY_SYSTEM_PREAMBLE},
+                {"role": "system", "content": context_prompt},
                 {"role": "user", "content": f"FILE: {request.file_path}\n\nCODE:\n{request.full_file_content}"}
             ],
             model="llama-3.3-70b-versatile",
             response_format={"type": "json_object"}
         )
+        log_token_usage("security", completion)
 
-        raw_content = completion.choices[0].message.content
-        print("[INFO] Security scan response received. Parsing...")
+        response = parse_review_response(completion.choices[0].message.content, "Security scan")
+        if response is None:
+            return ReviewResponse(comments=[])
 
-        try:
-            return ReviewResponse.model_validate_json(raw_content)
-        except Exception:
-            cleaned = clean_llm_json(raw_content)
-            try:
-                data = json.loads(cleaned)
-                return ReviewResponse.model_validate(data)
-            except Exception:
-                print(f"[WARNING] Security scan LLM returned unparseable response: {cleaned[:200]}")
-                return ReviewResponse(comments=[])
+        await _store_cached_response("security", request, prepared, embedding, response)
+        return response
 
     except Exception as e:
-        print(f"[ERROR] in security_scan: {str(e)}")
+        logger.error("in security_scan: %s", safe_error_message(e))
         raise HTTPException(status_code=500, detail=safe_error_message(e))
 
 
 # --- Feature 4: Complexity Analysis ---
 COMPLEXITY_THRESHOLD = 10
 
+_JS_BRANCH_TYPES = frozenset({
+    "if_statement", "for_statement", "for_in_statement", "while_statement",
+    "do_statement", "try_statement", "catch_clause", "switch_case",
+    "ternary_expression", "binary_expression",
+})
+
 BRANCH_TYPES = {
-    ".py": {"if_statement", "for_statement", "while_statement", "try_statement",
-            "except_clause", "with_statement", "conditional_expression",
-            "boolean_operator"},
-    ".js": {"if_statement", "for_statement", "for_in_statement", "while_statement",
-            "do_statement", "try_statement", "catch_clause", "switch_case",
-            "ternary_expression", "binary_expression"},
-    ".jsx": {"if_statement", "for_statement", "for_in_statement", "while_statement",
-             "do_statement", "try_statement", "catch_clause", "switch_case",
-             "ternary_expression", "binary_expression"},
-    ".ts": {"if_statement", "for_statement", "for_in_statement", "while_statement",
-            "do_statement", "try_statement", "catch_clause", "switch_case",
-            "ternary_expression", "binary_expression"},
-    ".tsx": {"if_statement", "for_statement", "for_in_statement", "while_statement",
-             "do_statement", "try_statement", "catch_clause", "switch_case",
-             "ternary_expression", "binary_expression"},
+    ".py": frozenset({"if_statement", "for_statement", "while_statement", "try_statement",
+                      "except_clause", "with_statement", "conditional_expression",
+                      "boolean_operator"}),
+    ".js": _JS_BRANCH_TYPES,
+    ".jsx": _JS_BRANCH_TYPES,
+    ".ts": _JS_BRANCH_TYPES,
+    ".tsx": _JS_BRANCH_TYPES,
 }
 
 # Node types that represent function boundaries (to skip nested functions)
+_JS_BOUNDARY_TYPES = frozenset({"function_declaration", "arrow_function", "method_definition"})
+
 FUNCTION_BOUNDARY_TYPES = {
-    ".py": {"function_definition"},
-    ".js": {"function_declaration", "arrow_function", "method_definition"},
-    ".jsx": {"function_declaration", "arrow_function", "method_definition"},
-    ".ts": {"function_declaration", "arrow_function", "method_definition"},
-    ".tsx": {"function_declaration", "arrow_function", "method_definition"},
+    ".py": frozenset({"function_definition"}),
+    ".js": _JS_BOUNDARY_TYPES,
+    ".jsx": _JS_BOUNDARY_TYPES,
+    ".ts": _JS_BOUNDARY_TYPES,
+    ".tsx": _JS_BOUNDARY_TYPES,
 }
 
 class FunctionComplexity(BaseModel):
@@ -463,113 +903,265 @@ class ComplexityResponse(BaseModel):
     threshold: int = COMPLEXITY_THRESHOLD
 
 
-def _count_branches(node, branch_types: set, boundary_types: set, code: str, ext: str) -> int:
-    """Count branch nodes within a function, stopping at nested function boundaries."""
-    count = 0
-    for child in node.children:
-        if child.type in boundary_types:
-            # Don't recurse into nested functions
-            continue
-        if child.type in branch_types:
-            # For JS/TS binary_expression, only count && and ||
-            if child.type == "binary_expression":
-                op_node = child.child_by_field_name("operator")
-                if op_node:
-                    op_text = code[op_node.start_byte:op_node.end_byte]
-                    if op_text in ("&&", "||"):
-                        count += 1
-            else:
-                count += 1
-        count += _count_branches(child, branch_types, boundary_types, code, ext)
-    return count
-
-
-def compute_complexity(code: str, file_path: str) -> List[FunctionComplexity]:
-    """Compute cyclomatic complexity for each function in the file."""
-    print(f"[DEBUG] Starting compute_complexity for {file_path}")
-    ext = os.path.splitext(file_path)[1].lower()
-    language = LANGUAGE_MAP.get(ext)
-    if not language:
-        print(f"[WARNING] Language not supported for complexity analysis: {ext}")
-        return []
-
-    local_parser = Parser(language)
-    tree = local_parser.parse(bytes(code, "utf8"))
-    function_types = AST_FUNCTION_TYPES.get(ext, set())
-    branch_types = BRANCH_TYPES.get(ext, set())
-    boundary_types = FUNCTION_BOUNDARY_TYPES.get(ext, set())
-
-    results = []
+def _function_name(node, code_bytes: bytes) -> Optional[str]:
+    """Name of a function/class node, falling back to the variable an arrow function is bound to."""
+    name_node = node.child_by_field_name("name")
+    if name_node:
+        return code_bytes[name_node.start_byte:name_node.end_byte].decode("utf-8", errors="replace")
+    if node.type == "arrow_function":
+        parent = node.parent
+        if parent and parent.type == "variable_declarator":
+            pname = parent.child_by_field_name("name")
+            if pname:
+                return code_bytes[pname.start_byte:pname.end_byte].decode("utf-8", errors="replace")
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def _node_kind_ids(ext: str, kinds: frozenset) -> frozenset:
+    """
+    Grammar symbol ids for a set of node type names. Matching on node.kind_id avoids
+    building a Python string for node.type at every node of the walk. Several ids can
+    share a name (aliases), so every matching id is included.
+    """
+    language = get_language(ext)
+    return frozenset(
+        kind_id for kind_id in range(language.node_kind_count)
+        if language.node_kind_for_id(kind_id) in kinds
+    )
+
+
+def _walk_tree(code_bytes: bytes, ext: str) -> Tuple[List[str], List[FunctionComplexity]]:
+    """
+    Parse the file and, in a single cursor walk, collect both the function/class
+    names used for AST context and the cyclomatic complexity of each of them.
+
+    Functions currently being walked are kept on a stack. A branch node counts towards
+    every open function up to and including the innermost function boundary, so a
+    nested function's branches never leak into its parent.
+
+    Node offsets from tree-sitter are byte offsets, so names are sliced from the
+    same UTF-8 buffer that was parsed.
+    """
+    with borrow_parser(ext) as parser:
+        tree = parser.parse(code_bytes)
+    function_ids = _node_kind_ids(ext, AST_FUNCTION_TYPES.get(ext, frozenset()))
+    branch_ids = _node_kind_ids(ext, BRANCH_TYPES.get(ext, frozenset()))
+    boundary_ids = _node_kind_ids(ext, FUNCTION_BOUNDARY_TYPES.get(ext, frozenset()))
+    binary_expression_ids = _node_kind_ids(ext, frozenset({"binary_expression"}))
+
+    names = []
+    # Per function, in discovery order: [name, line_number, branch_count, is_boundary]
+    records = []
+    # (depth, index into records) for every function enclosing the cursor
+    open_functions = []
     cursor = tree.walk()
+    depth = 0
 
+    # Every step moves the cursor to an unvisited node or back up towards the root,
+    # so the walk ends after visiting each node of the (finite) tree once.
     visited_children = False
-    loop_count = 0
     while True:
-        loop_count += 1
-        if loop_count > 100000:
-            print("BREAKING: Infinite loop detected in AST traversal")
-            break
-
         if not visited_children:
             node = cursor.node
-            if node.type in function_types:
-                # Get function name
-                name_node = node.child_by_field_name("name")
-                if name_node:
-                    name = code[name_node.start_byte:name_node.end_byte]
+            kind_id = node.kind_id
+            if kind_id in function_ids:
+                name = _function_name(node, code_bytes)
+                if name is not None:
+                    names.append(name)
                 elif node.type == "arrow_function":
-                    parent = node.parent
-                    if parent and parent.type == "variable_declarator":
-                        pname = parent.child_by_field_name("name")
-                        name = code[pname.start_byte:pname.end_byte] if pname else "<anonymous>"
-                    else:
-                        name = "<anonymous>"
-                else:
-                    name = "<anonymous>"
-
-                print(f"DEBUG: Found function '{name}' at line {node.start_point[0] + 1}")
-                
-                try:
-                    # Base complexity = 1, plus one for each branch
-                    branch_count = _count_branches(node, branch_types, boundary_types, code, ext)
-                    complexity = 1 + branch_count
-                    line_number = node.start_point[0] + 1  # 0-based to 1-based
-                    
-                    print(f"DEBUG: Analyzed '{name}' -> Complexity: {complexity}")
-
-                    results.append(FunctionComplexity(
-                        name=name,
-                        line_number=line_number,
-                        complexity=complexity,
-                        is_complex=complexity > COMPLEXITY_THRESHOLD,
-                    ))
-                except Exception as ex:
-                     print(f"ERROR calculating complexity for {name}: {str(ex)}")
-
-        if not visited_children and cursor.goto_first_child():
-            visited_children = False
-        elif cursor.goto_next_sibling():
+                    names.append("<anonymous arrow>")
+                line_number = node.start_point[0] + 1  # 0-based to 1-based
+                records.append([name if name is not None else "<anonymous>", line_number, 0, kind_id in boundary_ids])
+                open_functions.append((depth, len(records) - 1))
+            elif kind_id in branch_ids and open_functions:
+                # For JS/TS binary_expression, only count && and ||
+                is_branch = True
+                if kind_id in binary_expression_ids:
+                    op_node = node.child_by_field_name("operator")
+                    is_branch = bool(op_node) and code_bytes[op_node.start_byte:op_node.end_byte] in (b"&&", b"||")
+                if is_branch:
+                    for _, index in reversed(open_functions):
+                        records[index][2] += 1
+                        if records[index][3]:
+                            break
+
+            if cursor.goto_first_child():
+                depth += 1
+                continue
+
+        # Leaving the current node: close it if it is the innermost open function
+        if open_functions and open_functions[-1][0] == depth:
+            open_functions.pop()
+
+        if cursor.goto_next_sibling():
             visited_children = False
         elif cursor.goto_parent():
+            depth -= 1
             visited_children = True
         else:
             break
 
-    print(f"DEBUG: Completed complexity analysis for {file_path}. Found {len(results)} functions.")
-    return results
+    complexities = []
+    for name, line_number, branch_count, _ in records:
+        # Base complexity = 1, plus one for each branch
+        complexity = 1 + branch_count
+        complexities.append(FunctionComplexity(
+            name=name,
+            line_number=line_number,
+            complexity=complexity,
+            is_complex=complexity > COMPLEXITY_THRESHOLD,
+        ))
+    return names, complexities
+
+
+# --- AST ANALYSIS CACHE ---
+# Results of _walk_tree keyed by (ext, sha256(content)): an in-process LRU in front
+# of a size-bounded SQLite table that survives restarts. Bump AST_CACHE_VERSION
+# whenever the analysis output changes; tables from older versions are dropped.
+AST_CACHE_PATH = os.environ.get("AST_CACHE_PATH", "./ast_cache.db")
+AST_CACHE_VERSION = 3
+AST_CACHE_MEMORY_ENTRIES = 512
+AST_CACHE_MAX_ROWS = 5000
+
+_ast_cache_db = None
+_ast_cache_lock = threading.Lock()
+_ast_memory_cache = OrderedDict()  # (ext, content_hash) -> analysis, least recently used first
+
+def _get_ast_cache_db():
+    global _ast_cache_db
+    if _ast_cache_db is None:
+        _ast_cache_db = sqlite3.connect(AST_CACHE_PATH, check_same_thread=False)
+        _ast_cache_db.execute(f"""
+            CREATE TABLE IF NOT EXISTS ast_analysis_v{AST_CACHE_VERSION} (
+                hash TEXT NOT NULL,
+                ext TEXT NOT NULL,
+                functions_json TEXT NOT NULL,
+                complexity_json TEXT NOT NULL,
+                last_access REAL NOT NULL,
+                PRIMARY KEY (hash, ext)
+            )
+        """)
+        _ast_cache_db.execute(
+            f"CREATE INDEX IF NOT EXISTS ast_analysis_v{AST_CACHE_VERSION}_last_access "
+            f"ON ast_analysis_v{AST_CACHE_VERSION} (last_access)"
+        )
+        # Rows written by older analysis versions are never read again
+        stale_tables = [name for (name,) in _ast_cache_db.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'ast_analysis_v%'"
+        ) if name != f"ast_analysis_v{AST_CACHE_VERSION}"]
+        for name in stale_tables:
+            _ast_cache_db.execute(f'DROP TABLE "{name}"')
+        _ast_cache_db.commit()
+    return _ast_cache_db
+
+def _ast_cache_get(ext: str, content_hash: str):
+    with _ast_cache_lock:
+        db = _get_ast_cache_db()
+        row = db.execute(
+            f"SELECT functions_json, complexity_json FROM ast_analysis_v{AST_CACHE_VERSION} WHERE hash = ? AND ext = ?",
+            (content_hash, ext),
+        ).fetchone()
+        if row is None:
+            return None
+        db.execute(
+            f"UPDATE ast_analysis_v{AST_CACHE_VERSION} SET last_access = ? WHERE hash = ? AND ext = ?",
+            (time.time(), content_hash, ext),
+        )
+        db.commit()
+    names = json.loads(row[0])
+    # is_complex is not persisted so a changed COMPLEXITY_THRESHOLD applies to old rows too
+    complexities = [FunctionComplexity(**item, is_complex=item["complexity"] > COMPLEXITY_THRESHOLD)
+                    for item in json.loads(row[1])]
+    return names, complexities
+
+def _ast_cache_put(ext: str, content_hash: str, names: List[str], complexities: List[FunctionComplexity]):
+    table = f"ast_analysis_v{AST_CACHE_VERSION}"
+    with _ast_cache_lock:
+        db = _get_ast_cache_db()
+        db.execute(
+            f"INSERT OR REPLACE INTO {table} VALUES (?, ?, ?, ?, ?)",
+            (content_hash, ext, json.dumps(names),
+             json.dumps([c.model_dump(exclude={"is_complex"}) for c in complexities]), time.time()),
+        )
+        # Evict least recently used rows beyond the size bound (walks the last_access index)
+        (rows,) = db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()
+        if rows > AST_CACHE_MAX_ROWS:
+            db.execute(
+                f"DELETE FROM {table} WHERE rowid IN ("
+                f"SELECT rowid FROM {table} ORDER BY last_access LIMIT ?)",
+                (rows - AST_CACHE_MAX_ROWS,),
+            )
+        db.commit()
+
+def _cached_analysis(ext: str, content_hash: str, code_bytes: bytes) -> Tuple[Tuple[str, ...], Tuple[FunctionComplexity, ...]]:
+    # The in-memory layer is keyed on the hash only so it never pins file contents
+    key = (ext, content_hash)
+    with _ast_cache_lock:
+        if key in _ast_memory_cache:
+            _ast_memory_cache.move_to_end(key)
+            return _ast_memory_cache[key]
+
+    stored = None
+    try:
+        stored = _ast_cache_get(ext, content_hash)
+    except Exception as e:
+        logger.warning("AST cache read failed: %s", e)
+    if stored is None:
+        stored = _walk_tree(code_bytes, ext)
+        try:
+            _ast_cache_put(ext, content_hash, *stored)
+        except Exception as e:
+            logger.warning("AST cache write failed: %s", e)
+    names, complexities = stored
+    result = (tuple(names), tuple(complexities))
+
+    with _ast_cache_lock:
+        _ast_memory_cache[key] = result
+        _ast_memory_cache.move_to_end(key)
+        while len(_ast_memory_cache) > AST_CACHE_MEMORY_ENTRIES:
+            _ast_memory_cache.popitem(last=False)
+    return result
+
+
+def analyze_file(code_bytes: bytes, ext: str, content_hash: Optional[str] = None) -> Tuple[List[str], List[FunctionComplexity]]:
+    """
+    Function/class names and per-function complexity for a file, served from the
+    AST cache when the same content has been analyzed before. Callers skip
+    unsupported extensions and empty files (see PreparedFile).
+    """
+    if content_hash is None:
+        content_hash = content_sha256(code_bytes)
+    names, complexities = _cached_analysis(ext, content_hash, code_bytes)
+    return list(names), list(complexities)
 
 
 @app.post("/complexity", response_model=ComplexityResponse)
-def analyze_complexity(request: ComplexityRequest):
+async def analyze_complexity(
+    request: ComplexityRequest,
+    http_response: Response,
+    if_none_match: Optional[str] = Header(None),
+):
     """Compute cyclomatic complexity for all functions in the file."""
-    print(f"[INFO] Complexity analysis requested for {request.file_path}")
+    logger.info("Complexity analysis requested for %s", request.file_path)
+    prepared = _prepare_request(request)
+    if not prepared.ast_supported or not prepared.has_content:
+        return ComplexityResponse(functions=[])
     try:
-        functions = compute_complexity(request.full_file_content, request.file_path)
+        etag = compute_etag(request.file_path, prepared.content_hash, AST_CACHE_VERSION, COMPLEXITY_THRESHOLD)
+        if etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers={"ETag": etag})
+
+        _, functions = await asyncio.to_thread(
+            analyze_file, prepared.code_bytes, prepared.ext, prepared.content_hash
+        )
+        http_response.headers["ETag"] = etag
         return ComplexityResponse(functions=functions)
     except Exception as e:
-        print(f"[ERROR] in analyze_complexity: {str(e)}")
+        logger.error("in analyze_complexity: %s", safe_error_message(e))
         raise HTTPException(status_code=500, detail=safe_error_message(e))
 
 
 if __name__ == "__main__":
+    import uvicorn
     uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
@@ -1,32 +1,475 @@
+import os
+import tempfile
+os.environ.setdefault("GROQ_API_KEY", "test-key")
+os.environ.setdefault("AST_CACHE_PATH", os.path.join(tempfile.mkdtemp(), "ast_cache.db"))
+
 from fastapi.testclient import TestClient
-from unittest.mock import patch, MagicMock
-from main import app, get_ast_context
+from unittest.mock import patch, MagicMock, AsyncMock
+from main import app, ReviewResponse, CodeEmbedding
 
 client = TestClient(app)
 
 def test_ast_context():
-    code = "def foo(): pass\nclass Bar: pass"
-    context = get_ast_context(code)
+    from main import _ast_context_for_ext, content_sha256
+    code = b"def foo(): pass\nclass Bar: pass"
+    context = _ast_context_for_ext(code, ".py", content_sha256(code))
     # Note: our simple walker might only catch functions or might need adjustment
     # The current implementation in main.py looks for "function_definition"
     assert "foo" in context or "Found Functions" in context
 
-@patch("main.groq_client")
-@patch("main.style_collection")
-def test_review_endpoint(mock_collection, mock_groq):
+@patch("main.embed_texts", return_value=[[0.0, 1.0]])
+@patch("main.semantic_cache_lookup", return_value=(None, None))
+@patch("main.get_groq_client")
+@patch("main.get_style_collection")
+def test_review_endpoint(mock_get_collection, mock_groq, mock_lookup, mock_embed_texts):
     # Mock RAG
-    mock_collection.query.return_value = {'documents': [["Always use types."]]}
-    
+    mock_get_collection.return_value.query.return_value = {'documents': [["Always use types."]]}
+
     # Mock Groq
     mock_chat = MagicMock()
     mock_chat.choices[0].message.content = '{"comments": []}'
-    mock_groq.chat.completions.create.return_value = mock_chat
-    
+    mock_groq.return_value.chat.completions.create = AsyncMock(return_value=mock_chat)
+
     response = client.post("/review", json={
         "code_diff": "+ def foo(): pass",
         "full_file_content": "def foo(): pass",
         "file_path": "test.py"
     })
-    
+
     assert response.status_code == 200
     assert response.json() == {"comments": []}
+
+@patch("main.embed_code", return_value=CodeEmbedding([0.1, 0.2, 0.3], True))
+@patch("main.get_groq_client")
+@patch("main.get_cache_collection")
+def test_review_semantic_cache_hit(mock_get_cache, mock_groq, mock_embed):
+    cached = ReviewResponse.model_validate({"comments": [
+        {"line_number": 1, "suggestion": "Add a docstring.", "fixed_code": "def foo(): ...", "severity": "info"}
+    ]})
+    mock_get_cache.return_value.get.return_value = {'ids': [], 'documents': []}
+    mock_get_cache.return_value.query.return_value = {
+        'ids': [[".py:abc"]],
+        'distances': [[0.05]],
+        'documents': [[cached.model_dump_json()]],
+    }
+
+    response = client.post("/review", json={
+        "full_file_content": "def foo(): pass",
+        "file_path": "test.py"
+    })
+
+    assert response.status_code == 200
+    assert response.json() == cached.model_dump()
+    mock_groq.return_value.chat.completions.create.assert_not_called()
+    where = mock_get_cache.return_value.query.call_args.kwargs["where"]
+    assert {"file_path": "test.py"} in where["$and"]
+
+@patch("main.embed_code", return_value=CodeEmbedding([0.1, 0.2, 0.3], True))
+@patch("main.get_groq_client")
+@patch("main.get_cache_collection")
+def test_security_scan_semantic_cache_miss_stores_response(mock_get_cache, mock_groq, mock_embed):
+    collection = mock_get_cache.return_value
+    collection.get.return_value = {'ids': [], 'documents': []}
+    # Closest entry is too far away to count as a hit
+    collection.query.return_value = {'ids': [[".py:abc"]], 'distances': [[0.5]], 'documents': [["{}"]]}
+    collection.count.return_value = 1
+
+    mock_chat = MagicMock()
+    mock_chat.choices[0].message.content = '{"comments": []}'
+    mock_groq.return_value.chat.completions.create = AsyncMock(return_value=mock_chat)
+
+    response = client.post("/security-scan", json={
+        "full_file_content": "import os",
+        "file_path": "test.py"
+    })
+
+    assert response.status_code == 200
+    mock_groq.return_value.chat.completions.create.assert_called_once()
+    upsert_kwargs = collection.upsert.call_args.kwargs
+    assert upsert_kwargs["metadatas"][0]["endpoint"] == "security"
+    assert upsert_kwargs["metadatas"][0]["ext"] == ".py"
+    assert upsert_kwargs["metadatas"][0]["file_path"] == "test.py"
+
+@patch("main.embed_code", side_effect=AssertionError("exact hits must not embed"))
+@patch("main.get_groq_client")
+@patch("main.get_cache_collection")
+def test_review_exact_cache_hit_skips_embedding(mock_get_cache, mock_groq, mock_embed):
+    cached = ReviewResponse.model_validate({"comments": [
+        {"line_number": 1, "suggestion": "Add a docstring.", "fixed_code": "def foo(): ...", "severity": "info"}
+    ]})
+    mock_get_cache.return_value.get.return_value = {'ids': [".py:abc"], 'documents': [cached.model_dump_json()]}
+
+    response = client.post("/review", json={"full_file_content": "def foo(): pass", "file_path": "test.py"})
+
+    assert response.json() == cached.model_dump()
+    mock_get_cache.return_value.query.assert_not_called()
+    mock_groq.return_value.chat.completions.create.assert_not_called()
+
+@patch("main.embed_texts", return_value=[[0.0, 1.0]])
+@patch("main.embed_code", return_value=CodeEmbedding([0.1, 0.2, 0.3], False))
+@patch("main.get_groq_client")
+@patch("main.get_style_collection")
+@patch("main.get_cache_collection")
+def test_review_long_file_edited_after_header_misses_cache(mock_get_cache, mock_get_collection, mock_groq, mock_embed, mock_embed_texts):
+    # The encoder truncates long files, so an edit past the header embeds identically
+    # to the cached original; only an exact content match may be reused.
+    collection = mock_get_cache.return_value
+    collection.get.return_value = {'ids': [], 'documents': []}
+    collection.count.return_value = 1
+    mock_get_collection.return_value.query.return_value = {'documents': []}
+
+    mock_chat = MagicMock()
+    mock_chat.choices[0].message.content = '{"comments": []}'
+    mock_groq.return_value.chat.completions.create = AsyncMock(return_value=mock_chat)
+
+    header = "".join(f"import mod{i}\n" for i in range(300))
+    response = client.post("/review", json={
+        "full_file_content": header + "def foo():\n    return eval(input())\n",
+        "file_path": "long.py"
+    })
+
+    assert response.status_code == 200
+    collection.query.assert_not_called()
+    assert collection.get.call_args.kwargs["ids"][0].startswith(".py:")
+    mock_groq.return_value.chat.completions.create.assert_called_once()
+
+@patch("main.get_groq_client")
+def test_roast_sends_static_preamble_first(mock_groq):
+    from main import ROAST_SYSTEM_PREAMBLE
+    mock_chat = MagicMock()
+    mock_chat.choices[0].message.content = "WHAT IS THIS."
+    mock_groq.return_value.chat.completions.create = AsyncMock(return_value=mock_chat)
+
+    response = client.post("/roast", json={"full_file_content": "x = 1", "file_path": "a.py"})
+
+    assert response.status_code == 200
+    messages = mock_groq.return_value.chat.completions.create.call_args.kwargs["messages"]
+    assert messages[0] == {"role": "system", "content": ROAST_SYSTEM_PREAMBLE}
+
+def test_complexity_skips_nested_functions():
+    from main import analyze_file
+    code = (
+        b"def outer(x):\n"
+        b"    if x:\n"
+        b"        for i in range(x):\n"
+        b"            pass\n"
+        b"    def inner(y):\n"
+        b"        if y:\n"
+        b"            pass\n"
+        b"    return inner\n"
+    )
+    results = {f.name: f.complexity for f in analyze_file(code, ".py")[1]}
+    assert results == {"outer": 3, "inner": 2}
+
+def test_complexity_counts_logical_operators_in_js():
+    from main import analyze_file
+    code = b"function f(a, b) {\n  if (a && b || a) { return 1; }\n  return a + b;\n}\n"
+    _, results = analyze_file(code, ".js")
+    assert [(f.name, f.complexity) for f in results] == [("f", 4)]
+
+def test_analyze_file_shares_one_walk_for_names_and_complexity():
+    from main import analyze_file
+    code = (
+        b"class Shape:\n"
+        b"    if True:\n"
+        b"        kind = 1\n"
+        b"    def area(self):\n"
+        b"        return 1 if self else 0\n"
+        b"const = lambda: None\n"
+    )
+    names, complexities = analyze_file(code, ".py")
+    assert names == ["Shape", "area"]
+    assert [(f.name, f.line_number, f.complexity) for f in complexities] == [("Shape", 1, 2), ("area", 4, 2)]
+
+def test_analyze_file_names_anonymous_arrows():
+    from main import analyze_file
+    names, complexities = analyze_file(b"const add = (a, b) => a || b;\n[1].map(x => x);\n", ".js")
+    assert names == ["add", "<anonymous arrow>"]
+    assert [(f.name, f.complexity) for f in complexities] == [("add", 2), ("<anonymous>", 1)]
+
+def test_analyze_file_reuses_persisted_result():
+    import main
+    code = b"def cached(a):\n    if a:\n        return 1\n"
+    first = main.analyze_file(code, ".py")
+
+    # Simulate a restart: drop the in-memory layer so only SQLite can answer
+    main._ast_memory_cache.clear()
+    with patch("main._walk_tree", side_effect=AssertionError("should not re-parse")):
+        assert main.analyze_file(code, ".py") == first
+
+def test_ast_cache_drops_old_versions_and_evicts_least_recent(tmp_path):
+    import sqlite3
+    import main
+    path = str(tmp_path / "ast_cache.db")
+    old = sqlite3.connect(path)
+    old.execute("CREATE TABLE ast_analysis_v1 (hash TEXT)")
+    old.commit()
+    old.close()
+
+    with patch("main.AST_CACHE_PATH", path), patch("main._ast_cache_db", None), \
+            patch("main.AST_CACHE_MAX_ROWS", 2):
+        for i in range(3):
+            main._ast_cache_put(".py", f"hash{i}", [], [])
+        db = main._get_ast_cache_db()
+        tables = {name for (name,) in db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        hashes = {h for (h,) in db.execute(f"SELECT hash FROM ast_analysis_v{main.AST_CACHE_VERSION}")}
+        db.close()
+    assert tables == {f"ast_analysis_v{main.AST_CACHE_VERSION}"}
+    assert hashes == {"hash1", "hash2"}
+
+def test_persisted_analysis_uses_current_complexity_threshold():
+    import main
+    code = b"def branchy(a):\n    if a:\n        return 1\n"
+    _, (first,) = main.analyze_file(code, ".py")
+    assert first.complexity == 2 and not first.is_complex
+
+    # A restart with a lower threshold must re-flag rows written under the old one
+    main._ast_memory_cache.clear()
+    with patch("main.COMPLEXITY_THRESHOLD", 1), \
+            patch("main._walk_tree", side_effect=AssertionError("should not re-parse")):
+        _, (reread,) = main.analyze_file(code, ".py")
+    assert reread.is_complex
+    main._ast_memory_cache.clear()
+
+@patch("main.clear_semantic_cache")
+@patch("main.get_embedding_function")
+@patch("main.get_style_collection")
+def test_ingest_style_guide_batches_embeddings(mock_get_collection, mock_get_encoder, mock_clear_cache):
+    import main
+    encoder = mock_get_encoder.return_value
+    encoder.side_effect = lambda texts: [[0.0, 1.0] for _ in texts]
+    collection = mock_get_collection.return_value
+    collection.configuration_json = {"hnsw": {"space": "cosine", "max_neighbors": 32}}
+    collection.get.return_value = {"ids": []}
+    collection.count.return_value = 0
+    content = "\n\n".join(f"Rule {i}" for i in range(main.EMBEDDING_BATCH_SIZE + 1))
+
+    response = client.post("/ingest-style", json=content)
+
+    assert response.json() == {"status": "success", "chunks_indexed": main.EMBEDDING_BATCH_SIZE + 1}
+    assert [len(c.args[0]) for c in encoder.call_args_list] == [main.EMBEDDING_BATCH_SIZE, 1]
+    revision = collection.add.call_args.kwargs["metadatas"][0]["revision"]
+    collection.delete.assert_called_once_with(
+        where={"$and": [{"source": "style_guide"}, {"revision": {"$ne": revision}}]}
+    )
+    assert len(collection.add.call_args.kwargs["embeddings"]) == main.EMBEDDING_BATCH_SIZE + 1
+    mock_clear_cache.assert_called_once_with("review")
+
+@patch("main.clear_semantic_cache")
+@patch("main.get_embedding_function")
+@patch("main.get_style_collection")
+def test_ingest_style_guide_only_embeds_new_paragraphs(mock_get_collection, mock_get_encoder, mock_clear_cache):
+    import hashlib
+    mock_get_encoder.return_value.side_effect = lambda texts: [[0.0, 1.0] for _ in texts]
+    collection = mock_get_collection.return_value
+    collection.configuration_json = {"hnsw": {"space": "cosine", "max_neighbors": 32}}
+    kept_id = hashlib.sha1(b"Use snake_case.").hexdigest()[:16]
+    collection.get.return_value = {"ids": [kept_id]}
+
+    # Same guide again: nothing is re-embedded, re-tagged or invalidated
+    collection.count.return_value = 1
+    client.post("/ingest-style", json="Use snake_case.")
+    collection.add.assert_not_called()
+    collection.update.assert_not_called()
+    mock_clear_cache.assert_not_called()
+
+    # One paragraph added: only that one is embedded
+    client.post("/ingest-style", json="Use snake_case.\n\nPrefer f-strings.")
+    assert collection.add.call_args.kwargs["documents"] == ["Prefer f-strings."]
+    assert collection.update.call_args.kwargs["ids"] == [kept_id]
+    mock_clear_cache.assert_called_once_with("review")
+
+@patch("main.clear_semantic_cache")
+@patch("main.get_embedding_function")
+@patch("main.get_chroma_client")
+@patch("main.get_style_collection")
+def test_ingest_style_guide_rebuilds_untuned_index(mock_get_collection, mock_get_client, mock_get_encoder, mock_clear_cache):
+    mock_get_encoder.return_value.side_effect = lambda texts: [[0.0, 1.0] for _ in texts]
+    mock_get_collection.return_value.configuration_json = {"hnsw": {"space": "l2", "max_neighbors": 16}}
+
+    response = client.post("/ingest-style", json="Use snake_case.")
+
+    assert response.json() == {"status": "success", "chunks_indexed": 1}
+    mock_get_client.return_value.delete_collection.assert_called_once_with(name="style_guide")
+    mock_get_collection.return_value.delete.assert_not_called()
+
+def test_clean_llm_json_strips_fences():
+    from main import clean_llm_json
+    assert clean_llm_json('```json\n{"comments": []}\n```\n') == '{"comments": []}'
+    assert clean_llm_json('```{"comments": []}```') == '{"comments": []}'
+    assert clean_llm_json('{"comments": []}') == '{"comments": []}'
+
+def test_safe_error_message_redacts_keys():
+    from main import safe_error_message
+    message = safe_error_message(RuntimeError("bad key gsk_" + "a" * 40 + " rejected"))
+    assert message == "bad key [REDACTED] rejected"
+
+def test_analyze_file_slices_names_by_byte_offset():
+    from main import analyze_file
+    code = "# café ☕\ndef grüße():\n    pass\ndef after():\n    pass\n".encode("utf-8")
+    names, _ = analyze_file(code, ".py")
+    assert names == ["grüße", "after"]
+
+def test_parsers_are_reused_across_calls():
+    import main
+    with main.borrow_parser(".py") as first:
+        pass
+    with main.borrow_parser(".py") as second:
+        # A concurrent borrower gets its own parser
+        with main.borrow_parser(".py") as third:
+            assert third is not second
+    assert second is first
+
+@patch("main.embed_texts", return_value=[[0.0, 1.0]])
+@patch("main.get_style_collection")
+def test_style_query_embedding_is_reused(mock_get_collection, mock_embed_texts):
+    from main import query_style_rules, STYLE_QUERY_CHARS
+    header = "import os\n" * STYLE_QUERY_CHARS
+    query_style_rules(header + "print('a')")
+    query_style_rules(header + "print('b')")
+
+    mock_embed_texts.assert_called_once_with([header[:STYLE_QUERY_CHARS]])
+    assert mock_get_collection.return_value.query.call_args.kwargs["query_embeddings"] == [[0.0, 1.0]]
+
+def _fake_stream(*pieces):
+    async def stream():
+        for piece in pieces:
+            chunk = MagicMock()
+            chunk.choices[0].delta.content = piece
+            yield chunk
+    return stream()
+
+@patch("main.get_groq_client")
+def test_roast_stream_emits_tokens_then_done(mock_groq):
+    mock_groq.return_value.chat.completions.create = AsyncMock(return_value=_fake_stream("WHAT ", None, "IS THIS"))
+
+    response = client.post("/roast/stream", json={"full_file_content": "x = 1", "file_path": "a.py"})
+
+    assert response.headers["content-type"].startswith("text/event-stream")
+    assert response.text == (
+        'event: token\ndata: "WHAT "\n\n'
+        'event: token\ndata: "IS THIS"\n\n'
+        'event: done\ndata: {}\n\n'
+    )
+    assert mock_groq.return_value.chat.completions.create.call_args.kwargs["stream"] is True
+
+@patch("main.semantic_cache_store")
+@patch("main.embed_texts", return_value=[[0.0, 1.0]])
+@patch("main.semantic_cache_lookup", return_value=(None, None))
+@patch("main.get_groq_client")
+@patch("main.get_style_collection")
+def test_review_stream_ends_with_parsed_result(mock_get_collection, mock_groq, mock_lookup, mock_embed_texts, mock_store):
+    mock_get_collection.return_value.query.return_value = {'documents': []}
+    mock_groq.return_value.chat.completions.create = AsyncMock(return_value=_fake_stream('{"comments": ', '[]}'))
+
+    response = client.post("/review/stream", json={"full_file_content": "def foo(): pass", "file_path": "test.py"})
+
+    events = response.text.strip().split("\n\n")
+    assert events[-1] == 'event: result\ndata: {"comments": []}'
+    assert len(events) == 3
+
+@patch("main.embed_texts", return_value=[[0.0, 1.0]])
+@patch("main.semantic_cache_lookup", return_value=(None, None))
+@patch("main.get_groq_client")
+@patch("main.get_style_collection")
+def test_review_stream_reports_context_failures_as_events(mock_get_collection, mock_groq, mock_lookup, mock_embed_texts):
+    mock_get_collection.return_value.query.side_effect = RuntimeError("style index offline")
+
+    response = client.post("/review/stream", json={"full_file_content": "def foo(): pass", "file_path": "test.py"})
+
+    assert response.status_code == 200
+    assert response.text == 'event: error\ndata: {"detail": "style index offline"}\n\n'
+    mock_groq.return_value.chat.completions.create.assert_not_called()
+
+def test_parse_review_response_handles_fenced_and_invalid_payloads():
+    from main import parse_review_response
+    assert parse_review_response('{"comments": []}', "Review").comments == []
+    assert parse_review_response('```json\n{"comments": []}\n```', "Review").comments == []
+    assert parse_review_response('{"issues": []}', "Review") is None
+    assert parse_review_response('not json', "Review") is None
+
+def test_complexity_etag_short_circuits_repeat_submissions():
+    payload = {"full_file_content": "def foo(x):\n    if x:\n        return 1\n", "file_path": "etag.py"}
+    first = client.post("/complexity", json=payload)
+    etag = first.headers["ETag"]
+
+    with patch("main.analyze_file", side_effect=AssertionError("should not recompute")):
+        repeat = client.post("/complexity", json=payload, headers={"If-None-Match": etag})
+    assert repeat.status_code == 304
+    assert repeat.headers["ETag"] == etag
+
+    changed = client.post("/complexity", json={**payload, "full_file_content": "x = 1\n"},
+                          headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.headers["ETag"] != etag
+
+    wildcard = client.post("/complexity", json=payload, headers={"If-None-Match": "*"})
+    assert wildcard.status_code == 200
+
+@patch("main.embed_code")
+def test_review_etag_match_skips_all_work(mock_embed):
+    import main
+    payload = {"full_file_content": "def foo(): pass", "file_path": "test.py"}
+    content_hash = main.content_sha256(payload["full_file_content"].encode("utf-8"))
+    etag = main.compute_etag(payload["file_path"], content_hash, main._style_guide_revision)
+
+    response = client.post("/review", json=payload, headers={"If-None-Match": etag})
+
+    assert response.status_code == 304
+    mock_embed.assert_not_called()
+
+@patch("main.embed_texts", return_value=[[0.0, 1.0]])
+@patch("main.semantic_cache_lookup", return_value=(None, None))
+@patch("main.get_groq_client")
+@patch("main.get_style_collection")
+def test_review_batch_reviews_files_concurrently(mock_get_collection, mock_groq, mock_lookup, mock_embed_texts):
+    import asyncio
+    mock_get_collection.return_value.query.return_value = {'documents': []}
+    in_flight = {"now": 0, "peak": 0}
+
+    async def fake_create(**kwargs):
+        user_message = kwargs["messages"][-1]["content"]
+        in_flight["now"] += 1
+        in_flight["peak"] = max(in_flight["peak"], in_flight["now"])
+        await asyncio.sleep(0.01)
+        in_flight["now"] -= 1
+        if "broken.py" in user_message:
+            raise RuntimeError("rate limited")
+        chat = MagicMock()
+        chat.choices[0].message.content = '{"comments": []}'
+        return chat
+
+    mock_groq.return_value.chat.completions.create = AsyncMock(side_effect=fake_create)
+    files = [{"full_file_content": f"x = {i}", "file_path": f"f{i}.py"} for i in range(3)]
+    files.append({"full_file_content": "y = 1", "file_path": "broken.py"})
+
+    response = client.post("/review-batch", json={"files": files})
+
+    assert response.status_code == 200
+    reviews = response.json()["reviews"]
+    assert [r["file_path"] for r in reviews] == ["f0.py", "f1.py", "f2.py", "broken.py"]
+    assert reviews[-1]["error"] == "rate limited"
+    assert all(r["error"] is None for r in reviews[:-1])
+    assert in_flight["peak"] > 1
+
+@patch("main.analyze_file", side_effect=AssertionError("unsupported files are not analyzed"))
+def test_unsupported_extensions_skip_ast_analysis(mock_analyze):
+    response = client.post("/complexity", json={"full_file_content": "# Notes", "file_path": "README.md"})
+    assert response.status_code == 200
+    assert response.json()["functions"] == []
+
+    import asyncio
+    from main import _prepare_request, load_ast_context, ReviewRequest
+    prepared = _prepare_request(ReviewRequest(full_file_content="{}", file_path="data.JSON"))
+    assert prepared.ext == ".json"
+    assert asyncio.run(load_ast_context(prepared)).startswith("AST parsing not available for '.json'")
+
+@patch("main.analyze_file", side_effect=AssertionError("empty files are not parsed"))
+def test_empty_files_short_circuit(mock_analyze):
+    import asyncio
+    from main import _prepare_request, load_ast_context, ReviewRequest
+    prepared = _prepare_request(ReviewRequest(full_file_content="  \n\n", file_path="empty.py"))
+    assert asyncio.run(load_ast_context(prepared)) == "Empty file"
+
+    response = client.post("/complexity", json={"full_file_content": "", "file_path": "empty.ts"})
+    assert response.json()["functions"] == []